@@ -0,0 +1,339 @@
+# Import libraries
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Working-set cost of a chunk, measured with tracemalloc- per (date, ticker) cell, per date, and fixed
+BYTES_PER_CELL = 256
+BYTES_PER_ROW = 256
+FIXED_OVERHEAD = 2 * 1024 ** 2
+
+# Rows per write when streaming frames to csv, keeps the string conversion buffers small
+CSV_CHUNKSIZE = 2_000
+
+# Default memory budget for a chunked backtest (bytes)
+DEFAULT_MEMORY_BUDGET = 512 * 1024 ** 2
+
+# Function to merge a sorted, unique block of dates into the sorted, unique on-disk date axis
+#
+# The axis is a raw int64 file of nanosecond timestamps. It is streamed through in blocks into a
+# new file, so neither the existing axis nor the merged result is ever held in memory whole.
+def _merge_dates(path, new, block = 1_000_000):
+
+    new = new.astype('int64')
+    tmp = path + '.tmp'
+    old = np.memmap(path, dtype = 'int64', mode = 'r') if os.path.exists(path) and os.path.getsize(path) else np.empty(0, dtype = 'int64')
+
+    with open(tmp, 'wb') as f:
+
+        pos = 0
+
+        for a in range(0, len(old), block):
+
+            part = np.array(old[a:a + block])
+
+            # New dates up to the end of this block belong with it, the rest wait for later blocks
+            end = len(new) if a + block >= len(old) else np.searchsorted(new, part[-1], side = 'right')
+
+            f.write(np.union1d(part, new[pos:end]).tobytes())
+            pos = end
+
+        f.write(new[pos:].tobytes())
+
+    del old
+
+    os.replace(tmp, path)
+
+# Function to convert a long-format price csv (Date, ticker, price) into a memory-mapped store
+#
+# The store is a directory holding a dense date x ticker float64 price matrix, a presence mask
+# recording which (date, ticker) rows actually exist in the csv, the sorted dates and the tickers.
+# The csv is read twice in chunks so it never has to fit in memory. Rows are expected to be in
+# date order within each ticker, which is what the in-memory backtest relies on as well.
+def build_price_store(csv_path, store_path, chunksize = 1_000_000):
+
+    os.makedirs(store_path, exist_ok = True)
+
+    # First pass- collect the distinct dates on disk and the distinct tickers
+    dates_path = os.path.join(store_path, 'dates.i8')
+    tickers = set()
+
+    if os.path.exists(dates_path):
+
+        os.remove(dates_path)
+
+    for chunk in pd.read_csv(csv_path, usecols = ['Date', 'ticker'], chunksize = chunksize):
+
+        _merge_dates(dates_path, np.unique(pd.to_datetime(chunk['Date']).to_numpy(dtype = 'datetime64[ns]')))
+        tickers.update(chunk['ticker'].unique())
+
+    dates = np.memmap(dates_path, dtype = 'datetime64[ns]', mode = 'r')
+    tickers = sorted(tickers)
+
+    shape = (len(dates), len(tickers))
+
+    prices = np.memmap(os.path.join(store_path, 'prices.f8'), dtype = 'float64', mode = 'w+', shape = shape)
+    present = np.memmap(os.path.join(store_path, 'present.u1'), dtype = 'uint8', mode = 'w+', shape = shape)
+
+    # Second pass- scatter each price into its (date, ticker) cell
+    columns = pd.Index(tickers)
+
+    for chunk in pd.read_csv(csv_path, usecols = ['Date', 'ticker', 'price'], chunksize = chunksize):
+
+        rows = np.searchsorted(dates, pd.to_datetime(chunk['Date']).to_numpy(dtype = 'datetime64[ns]'))
+        cols = columns.get_indexer(chunk['ticker'])
+
+        prices[rows, cols] = chunk['price'].to_numpy(dtype = 'float64')
+        present[rows, cols] = 1
+
+    prices.flush()
+    present.flush()
+
+    # Rows per ticker, counted in blocks of dates
+    counts = np.zeros(len(tickers), dtype = 'int64')
+
+    for a in range(0, len(dates), chunksize):
+
+        counts += np.asarray(present[a:a + chunksize]).sum(axis = 0, dtype = 'int64')
+
+    del dates
+
+    with open(os.path.join(store_path, 'meta.json'), 'w') as f:
+
+        json.dump({'tickers': tickers, 'shape': list(shape), 'counts': counts.tolist()}, f)
+
+    return PriceStore(store_path)
+
+# Read-only view over a store written by build_price_store
+class PriceStore:
+
+    def __init__(self, store_path):
+
+        with open(os.path.join(store_path, 'meta.json')) as f:
+
+            meta = json.load(f)
+
+        shape = tuple(meta['shape'])
+
+        self.path = store_path
+        self.tickers = meta['tickers']
+        self.counts = dict(zip(meta['tickers'], meta['counts']))
+        self.dates = np.memmap(os.path.join(store_path, 'dates.i8'), dtype = 'datetime64[ns]', mode = 'r', shape = (shape[0],))
+        self.prices = np.memmap(os.path.join(store_path, 'prices.f8'), dtype = 'float64', mode = 'r', shape = shape)
+        self.present = np.memmap(os.path.join(store_path, 'present.u1'), dtype = 'uint8', mode = 'r', shape = shape)
+
+    # Split tickers into those with prices in the store and those without
+    def split_tickers(self, tickers):
+
+        known = set(self.tickers)
+
+        return [t for t in tickers if t in known], [t for t in tickers if t not in known]
+
+    # Yield time-ordered blocks of (dates, prices, present) restricted to the requested tickers
+    def iter_chunks(self, tickers, rows):
+
+        cols = pd.Index(self.tickers).get_indexer(tickers)
+
+        for a in range(0, len(self.dates), rows):
+
+            b = min(a + rows, len(self.dates))
+
+            yield pd.DatetimeIndex(np.asarray(self.dates[a:b])), np.asarray(self.prices[a:b][:, cols]), np.asarray(self.present[a:b][:, cols]).astype(bool)
+
+# Function to size chunks so the working set stays inside the memory budget
+def rows_per_chunk(n_tickers, shortwindow, longwindow, memory_budget = DEFAULT_MEMORY_BUDGET):
+
+    # Rolling windows carried across chunk boundaries are the only state that outlives a chunk
+    carry = n_tickers * max(shortwindow, longwindow) * 8 * 2
+
+    return max(1, int((memory_budget - carry - FIXED_OVERHEAD) // (max(n_tickers, 1) * BYTES_PER_CELL + BYTES_PER_ROW)))
+
+# Per-ticker state carried from one chunk into the next
+class _TickerState:
+
+    def __init__(self, startingcash):
+
+        self.tail = np.empty(0)
+        self.count = 0
+        self.signal = np.nan
+        self.shares = np.nan
+        self.cash = float(startingcash)
+        self.total = np.nan
+
+# Function to stream the moving average backtest over a price store chunk by chunk
+#
+# Mirrors strategy.generate_signals() and strategy.portfolio_backtest() row for row: both rolling
+# means use min_periods = 1, the first `shortwindow` rows of each ticker keep a signal of 0, and the
+# daily aggregate only sums tickers that have a row on that date. Like the in-memory path it raises
+# ValueError when a ticker has fewer rows than `shortwindow`. Tickers without prices in the store are
+# skipped rather than raising, callers of the in-memory path filter them out the same way.
+#
+# Yields (signals, backtest, performance) frames for each chunk so callers can persist them without
+# holding the full history. Drop each chunk's frames before asking for the next one to stay inside
+# the memory budget.
+def iter_backtest(store, tickers, startingcash, numshares, shortwindow, longwindow, memory_budget = DEFAULT_MEMORY_BUDGET):
+
+    if shortwindow < 1 or longwindow < 1:
+
+        raise ValueError(f'Moving average windows must be at least 1, got shortwindow = {shortwindow} and longwindow = {longwindow}')
+
+    tickers = store.split_tickers(list(tickers))[0]
+
+    short_history = [t for t in tickers if store.counts[t] < shortwindow]
+
+    if short_history:
+
+        raise ValueError(f'Fewer than shortwindow = {shortwindow} rows of prices for {short_history}')
+
+    # Output rows are grouped by ticker in alphabetical order, as groupby('ticker') does in memory
+    tickers = sorted(tickers)
+    keep = max(shortwindow, longwindow) - 1
+    states = [_TickerState(startingcash) for _ in tickers]
+    rows = rows_per_chunk(len(tickers), shortwindow, longwindow, memory_budget)
+
+    for dates, prices, present in store.iter_chunks(tickers, rows):
+
+        # Output columns are written straight into two preallocated blocks, one row per (date, ticker) present
+        counts = present.sum(axis = 0)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+
+        sig = np.empty((starts[-1], 5))
+        bt = np.empty((starts[-1], 5))
+        when = np.empty(starts[-1], dtype = 'datetime64[ns]')
+        codes = np.repeat(np.arange(len(tickers), dtype = 'int32'), counts)
+
+        perf = np.zeros((len(dates), 3))
+
+        for j, state in enumerate(states):
+
+            if not counts[j]:
+
+                continue
+
+            mask = present[:, j]
+            out = slice(starts[j], starts[j + 1])
+
+            price = prices[mask, j]
+            when[out] = dates[mask]
+
+            # Calculate sma / lma over the carried tail plus the new rows
+            seq = pd.Series(np.concatenate([state.tail, price]))
+            short = seq.rolling(window = shortwindow, min_periods = 1, center = False).mean().to_numpy()[len(state.tail):]
+            long = seq.rolling(window = longwindow, min_periods = 1, center = False).mean().to_numpy()[len(state.tail):]
+
+            # Create signals, the first `shortwindow` rows of a ticker are never traded
+            position = state.count + np.arange(len(price))
+            signal = np.where((position >= shortwindow) & (short > long), 1.0, 0.0)
+
+            sig[out, 0] = price
+            sig[out, 1] = signal
+            sig[out, 2] = short
+            sig[out, 3] = long
+            sig[out, 4] = np.diff(signal, prepend = state.signal)
+
+            # Portfolio accounting
+            shares = numshares * signal
+            pos_diff = np.diff(shares, prepend = state.shares)
+
+            bt[out, 0] = shares * price
+            bt[out, 1] = np.nan_to_num(bt[out, 0], nan = 0.0)
+            bt[out, 2] = state.cash - np.cumsum(np.nan_to_num(pos_diff * price, nan = 0.0))
+            bt[out, 3] = bt[out, 2] + bt[out, 1]
+
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+                bt[out, 4] = bt[out, 3] / np.concatenate([[state.total], bt[out, 3][:-1]]) - 1
+
+            perf[mask] += bt[out, 1:4]
+
+            # Carry state across the chunk boundary
+            state.tail = np.concatenate([state.tail, price])[-keep:] if keep else np.empty(0)
+            state.count += len(price)
+            state.signal = signal[-1]
+            state.shares = shares[-1]
+            state.cash = bt[out, 2][-1]
+            state.total = bt[out, 3][-1]
+
+        index = pd.DatetimeIndex(when, name = 'Date')
+        ticker = pd.Categorical.from_codes(codes, categories = tickers)
+
+        signals = pd.DataFrame(sig, index = index, columns = ['price', 'signal', 'short', 'long', 'positions'], copy = False)
+        signals.insert(0, 'ticker', ticker)
+
+        backtest = pd.DataFrame(bt, index = index, columns = ['shares', 'holdings', 'cash', 'total', 'returns'], copy = False)
+        backtest['ticker'] = ticker
+
+        # Compile the performance from all stocks on dates where at least one has a row
+        active = present.any(axis = 1)
+
+        performance = pd.DataFrame(perf[active], index = pd.DatetimeIndex(dates[active], name = 'Date'), columns = ['holdings', 'cash', 'total'], copy = False)
+
+        del sig, bt, when, codes, perf, index, ticker, dates, prices, present
+
+        yield signals, backtest, performance
+
+        # Let go of this chunk before building the next one
+        del signals, backtest, performance
+
+# Function to run a chunked backtest end to end
+#
+# Per-ticker signals and backtest rows are appended to csv files when paths are given and dropped
+# otherwise. The daily aggregate performance is returned whole, unless performance_path is given- then
+# it is streamed to that csv and only its last row is returned so the ending balance is still at hand.
+def chunked_backtest(store, tickers, startingcash, numshares, shortwindow, longwindow, memory_budget = DEFAULT_MEMORY_BUDGET, signals_path = None, backtest_path = None, performance_path = None):
+
+    performance = []
+    written = set()
+
+    for signals, backtest, perf in iter_backtest(store, tickers, startingcash, numshares, shortwindow, longwindow, memory_budget):
+
+        for path, frame in [(signals_path, signals), (backtest_path, backtest), (performance_path, perf)]:
+
+            if path is not None and len(frame):
+
+                frame.to_csv(path, mode = 'a' if path in written else 'w', header = path not in written, chunksize = CSV_CHUNKSIZE)
+                written.add(path)
+
+        if performance_path is None:
+
+            performance.append(perf)
+
+        elif len(perf):
+
+            performance = [perf.iloc[-1:].copy()]
+
+        del signals, backtest, perf, frame
+
+    return pd.concat(performance) if performance else pd.DataFrame(columns = ['holdings', 'cash', 'total'])
+
+# Function to read an evenly spaced sample of at most `points` rows from a csv, always keeping the last row
+def read_downsampled(path, points = 2_000, chunksize = 100_000):
+
+    n = sum(len(chunk) for chunk in pd.read_csv(path, usecols = [0], chunksize = chunksize))
+    step = max(1, -(-n // points))
+
+    sample = []
+    seen = 0
+
+    for chunk in pd.read_csv(path, index_col = 0, parse_dates = True, chunksize = chunksize):
+
+        position = seen + np.arange(len(chunk))
+        sample.append(chunk[(position % step == 0) | (position == n - 1)])
+        seen += len(chunk)
+
+    return pd.concat(sample) if sample else pd.DataFrame()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Build a memory-mapped price store for chunked backtesting')
+    parser.add_argument('csv', help = 'Long-format price csv with Date, ticker and price columns')
+    parser.add_argument('store', help = 'Directory to write the store into')
+    parser.add_argument('--chunksize', type = int, default = 1_000_000, help = 'Rows of csv to read at a time')
+
+    args = parser.parse_args()
+
+    store = build_price_store(args.csv, args.store, args.chunksize)
+
+    print(f'Wrote {len(store.dates)} dates x {len(store.tickers)} tickers to {args.store}')
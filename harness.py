@@ -0,0 +1,376 @@
+# Import libraries
+import os
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+import strategy
+import chunked
+
+# Columns every engine has to reproduce
+SIGNAL_COLUMNS = ['signal', 'short', 'long', 'positions']
+BACKTEST_COLUMNS = ['shares', 'holdings', 'cash', 'total', 'returns']
+PERFORMANCE_COLUMNS = ['holdings', 'cash', 'total']
+
+# The reference was frozen under pandas 2- under copy-on-write (pandas 3) its chained assignment
+# `grp['signal'][shortwindow:] = ...` silently stops writing, which changes the reference itself
+REFERENCE_PANDAS_MAJOR = 2
+
+# Frozen copy of generate_signals() as shipped, do not optimise- every other engine is diffed against it
+def _reference_generate_signals(df, ticker, shortwindow, longwindow):
+
+    # Get the data isolate
+    grp = df[df['ticker'] == ticker]
+
+    # Calculate
+    grp['signal'] = 0.0
+
+    # Calculate sma
+    grp['short'] = grp['price'].rolling(window = shortwindow, min_periods = 1, center = False).mean()
+
+    # Calculate lma
+    grp['long'] = grp['price'].rolling(window = longwindow, min_periods = 1, center = False).mean()
+
+    # Create signals
+    grp['signal'][shortwindow:] = np.where(grp['short'][shortwindow:] > grp['long'][shortwindow:], 1.0, 0.0)
+
+    # Generate trading orders
+    grp['positions'] = grp['signal'].diff()
+
+    grp.index = pd.DatetimeIndex(grp['Date'])
+
+    return grp
+
+# Frozen copy of the portfolio loop in backtesting() as shipped
+def _reference_backtest(df, tickers, startingcash, numshares, shortwindow, longwindow):
+
+    signals = pd.DataFrame()
+    backtest = pd.DataFrame()
+
+    for nm in tickers:
+
+        signals = pd.concat([signals, _reference_generate_signals(df, nm, shortwindow, longwindow)])
+
+    signals.set_index('Date', inplace = True)
+
+    for nm, grp in signals.groupby('ticker'):
+
+        pos = pd.DataFrame(index = grp.index).fillna(0)
+
+        pos['shares'] = numshares * grp['signal']
+
+        portfolio = pos.multiply(grp['price'], axis = 0)
+        pos_diff = pos.diff()
+
+        portfolio['holdings'] = (pos.multiply(grp['price'], axis = 0)).sum(axis = 1)
+        portfolio['cash'] = startingcash - (pos_diff.multiply(grp['price'], axis = 0)).sum(axis = 1).cumsum()
+        portfolio['total'] = portfolio['cash'] + portfolio['holdings']
+        portfolio['returns'] = portfolio['total'].pct_change()
+        portfolio['ticker'] = nm
+
+        backtest = pd.concat([backtest, portfolio])
+
+    performance = backtest.groupby(backtest.index).agg({'holdings': 'sum',
+                                                        'cash': 'sum',
+                                                        'total': 'sum'})
+
+    return signals, backtest, performance
+
+# Live engine in strategy.py
+def _strategy_backtest(df, tickers, startingcash, numshares, shortwindow, longwindow):
+
+    signals = strategy.portfolio_signals(df, tickers, shortwindow, longwindow)
+    backtest = strategy.portfolio_backtest(signals, startingcash, numshares)
+
+    return signals, backtest, strategy.aggregate_performance(backtest)
+
+# Chunked engine- the store is built outside the timed section, and the budget is kept tiny so chunk boundaries are exercised
+def _prepare_chunked(df, workdir):
+
+    path = os.path.join(workdir, 'prices.csv')
+    df.to_csv(path, index = False)
+
+    return chunked.build_price_store(path, os.path.join(workdir, 'prices.store'))
+
+def _chunked_backtest(store, tickers, startingcash, numshares, shortwindow, longwindow, rows = 7):
+
+    carry = len(tickers) * max(shortwindow, longwindow) * 8 * 2
+    budget = carry + len(tickers) * chunked.BYTES_PER_CELL * rows
+
+    frames = list(chunked.iter_backtest(store, tickers, startingcash, numshares, shortwindow, longwindow, budget))
+
+    return pd.concat([f[0] for f in frames]), pd.concat([f[1] for f in frames]), pd.concat([f[2] for f in frames])
+
+# Engines under test- name -> (prepare, run). prepare turns the long price frame into whatever run consumes
+ENGINES = {'strategy': (lambda df, workdir: df, _strategy_backtest),
+           'chunked': (_prepare_chunked, _chunked_backtest)}
+
+# How each engine is documented to handle inputs the reference rejects- either the exception it must
+# raise as well, or 'skips' to drop the offending tickers and match the reference run without them
+EDGE_BEHAVIOUR = {'strategy': {'short_history': ValueError, 'zero_window': ValueError, 'unpriced_ticker': ValueError},
+                  'chunked': {'short_history': ValueError, 'zero_window': ValueError, 'unpriced_ticker': 'skips'}}
+
+# Function to generate a synthetic long-format universe w/ ragged histories and missing prices
+#
+# Every ticker keeps at least `min_rows` rows, so any shortwindow up to that runs through the numeric diff.
+def synthetic_universe(rng, n_tickers = 8, n_dates = 300, nan_rate = .02, min_rows = 100):
+
+    dates = pd.bdate_range('2020-01-01', periods = n_dates)
+    frames = []
+
+    for i in range(n_tickers):
+
+        # Ragged- each ticker lists late, delists early and skips some days
+        first = rng.integers(0, n_dates - min_rows + 1)
+        last = rng.integers(first + min_rows, n_dates + 1)
+        keep = rng.random(last - first) > rng.uniform(0, .1)
+        keep[rng.choice(last - first, min_rows, replace = False)] = True
+
+        days = dates[first:last][keep]
+
+        price = 100 * np.exp(np.cumsum(rng.normal(0, .02, len(days))))
+        price[rng.random(len(days)) < nan_rate] = np.nan
+
+        frames.append(pd.DataFrame({'Date': days, 'ticker': f'T{i:03d}', 'price': price}))
+
+    return pd.concat(frames, ignore_index = True)
+
+# Window pairs for the numeric diff- unit windows, equal windows, short > long, a shortwindow equal to the
+# shortest history and a longwindow longer than any history, plus random pairs
+def window_cases(rng, n_dates, min_rows):
+
+    cases = [(1, 1), (1, 2), (2, 1), (5, 5), (30, 90), (90, 30), (min_rows, n_dates + 10)]
+    cases += [(int(rng.integers(1, min_rows + 1)), int(rng.integers(1, n_dates + 10))) for _ in range(3)]
+
+    return cases
+
+# Inputs the reference rejects- name -> (universe, portfolio, shortwindow, longwindow, tickers to drop when an engine skips)
+def edge_cases(rng, n_tickers, n_dates, min_rows):
+
+    df = synthetic_universe(rng, n_tickers, n_dates, min_rows = min_rows)
+    tickers = sorted(df['ticker'].unique())
+
+    # One ticker listed only for a few days, fewer rows than the short window
+    stub = pd.DataFrame({'Date': pd.bdate_range('2020-01-01', periods = 3), 'ticker': 'STUB', 'price': [100., 101., 102.]})
+
+    return {'short_history': (pd.concat([df, stub], ignore_index = True), tickers + ['STUB'], 10, 30, ['STUB']),
+            'zero_window': (df, tickers, 0, 90, []),
+            'unpriced_ticker': (df, tickers + ['NOPRICE'], 30, 90, ['NOPRICE'])}
+
+# Function to line up two frames row for row- per ticker (when there is one), in date order
+def _normalise(frame):
+
+    frame = frame.reset_index()
+
+    if 'ticker' in frame:
+
+        frame = frame.sort_values('ticker', kind = 'stable')
+
+    return frame.reset_index(drop = True)
+
+# Function to compare two arrays, returns (max abs difference, within tolerance)
+def _compare(a, b, rtol, atol):
+
+    with np.errstate(invalid = 'ignore'):
+
+        gap = np.nanmax(np.abs(a - b), initial = 0.0)
+
+    return gap, bool(np.allclose(a, b, rtol = rtol, atol = atol, equal_nan = True))
+
+# Function to diff one engine's output against the reference, returns the max abs difference per column
+#
+# Covers the per-ticker signal and portfolio columns, the daily aggregate (prefixed `performance_`)
+# and the ending balance the dashboard reports.
+def diff_outputs(reference, candidate, rtol = 1e-9, atol = 1e-6):
+
+    report = {}
+
+    for ref, cand, columns, prefix in [(reference[0], candidate[0], SIGNAL_COLUMNS, ''),
+                                       (reference[1], candidate[1], BACKTEST_COLUMNS, ''),
+                                       (reference[2], candidate[2], PERFORMANCE_COLUMNS, 'performance_')]:
+
+        ref = _normalise(ref)
+        cand = _normalise(cand)
+        keys = ['ticker', 'Date'] if 'ticker' in ref else ['Date']
+
+        if len(ref) != len(cand) or any(not (ref[k].to_numpy() == cand[k].to_numpy()).all() for k in keys):
+
+            report.update({prefix + col: (np.inf, False) for col in columns})
+
+            continue
+
+        for col in columns:
+
+            report[prefix + col] = _compare(ref[col].to_numpy(dtype = 'float64'), cand[col].to_numpy(dtype = 'float64'), rtol, atol)
+
+    # Ending balance as the dashboard reads it
+    ending = [frame['total'].iloc[-1] if len(frame) else np.nan for frame in (reference[2], candidate[2])]
+
+    report['endingcash'] = _compare(np.array(ending[:1], dtype = 'float64'), np.array(ending[1:], dtype = 'float64'), rtol, atol)
+
+    return report
+
+# Function to time a call, returns (result or raised exception, seconds)
+def _timed(fn, *args):
+
+    began = time.perf_counter()
+
+    try:
+
+        result = fn(*args)
+
+    except Exception as e:
+
+        result = e
+
+    return result, time.perf_counter() - began
+
+# Function to run every engine against the reference over randomised universes
+def run(engines = None, trials = 5, seed = 0, n_tickers = 8, n_dates = 300, startingcash = 10000, numshares = 100, min_rows = None):
+
+    engines = ENGINES if engines is None else engines
+    min_rows = n_dates // 3 if min_rows is None else min_rows
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    # The reference (and strategy.py) rely on chained assignment, only its pandas warnings are silenced
+    with warnings.catch_warnings():
+
+        warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+        warnings.simplefilter('ignore', FutureWarning)
+
+        for trial in range(trials):
+
+            rows += _run_trial(engines, rng, trial, n_tickers, n_dates, min_rows, startingcash, numshares)
+            rows += _run_edge_cases(engines, rng, trial, n_tickers, n_dates, min_rows, startingcash, numshares)
+
+    return pd.DataFrame(rows)
+
+# Function to score one engine run against the reference run on the same inputs
+def _score(row, reference, candidate):
+
+    if isinstance(reference, Exception) or isinstance(candidate, Exception):
+
+        row['match'] = False
+        row['error'] = repr(candidate) if isinstance(candidate, Exception) else repr(reference)
+
+    else:
+
+        report = diff_outputs(reference, candidate)
+
+        row.update({f'{col}_diff': gap for col, (gap, _) in report.items()})
+        row['match'] = all(ok for _, ok in report.values())
+
+    return row
+
+# Function to run one randomised universe through the reference and every engine- every case here must compute
+def _run_trial(engines, rng, trial, n_tickers, n_dates, min_rows, startingcash, numshares):
+
+    rows = []
+
+    df = synthetic_universe(rng, n_tickers, n_dates, min_rows = min_rows)
+    tickers = list(rng.permutation(df['ticker'].unique()))
+
+    with tempfile.TemporaryDirectory() as workdir:
+
+        prepared = {name: prepare(df, workdir) for name, (prepare, _) in engines.items()}
+
+        for shortwindow, longwindow in window_cases(rng, n_dates, min_rows):
+
+            args = (tickers, startingcash, numshares, shortwindow, longwindow)
+
+            reference, ref_time = _timed(_reference_backtest, df.copy(), *args)
+
+            for name, (_, engine) in engines.items():
+
+                candidate, time_taken = _timed(engine, prepared[name], *args)
+
+                row = {'trial': trial, 'case': 'numeric', 'engine': name, 'shortwindow': shortwindow, 'longwindow': longwindow,
+                       'reference_s': ref_time, 'engine_s': time_taken, 'speedup': ref_time / time_taken}
+
+                rows.append(_score(row, reference, candidate))
+
+    return rows
+
+# Function to check every engine against its documented behaviour on inputs the reference rejects
+def _run_edge_cases(engines, rng, trial, n_tickers, n_dates, min_rows, startingcash, numshares):
+
+    rows = []
+
+    for case, (df, tickers, shortwindow, longwindow, offending) in edge_cases(rng, n_tickers, n_dates, min_rows).items():
+
+        reference, ref_time = _timed(_reference_backtest, df.copy(), tickers, startingcash, numshares, shortwindow, longwindow)
+
+        with tempfile.TemporaryDirectory() as workdir:
+
+            for name, (prepare, engine) in engines.items():
+
+                expected = EDGE_BEHAVIOUR[name][case]
+                candidate, time_taken = _timed(engine, prepare(df, workdir), tickers, startingcash, numshares, shortwindow, longwindow)
+
+                row = {'trial': trial, 'case': case, 'engine': name, 'shortwindow': shortwindow, 'longwindow': longwindow,
+                       'reference_s': ref_time, 'engine_s': time_taken, 'speedup': ref_time / time_taken,
+                       'error': repr(candidate) if isinstance(candidate, Exception) else None}
+
+                # The reference itself has to reject the input, or the case no longer tests anything
+                if not isinstance(reference, ValueError):
+
+                    row['match'] = False
+                    row['error'] = f'reference did not raise ValueError: {reference!r}'
+
+                elif expected == 'skips':
+
+                    kept = [t for t in tickers if t not in offending]
+
+                    rows.append(_score(row, _reference_backtest(df.copy(), kept, startingcash, numshares, shortwindow, longwindow), candidate))
+
+                    continue
+
+                else:
+
+                    row['match'] = isinstance(candidate, expected)
+
+                rows.append(row)
+
+    return rows
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Diff alternative backtest engines against the frozen reference')
+    parser.add_argument('--engines', nargs = '+', default = list(ENGINES), choices = list(ENGINES))
+    parser.add_argument('--trials', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--tickers', type = int, default = 8)
+    parser.add_argument('--dates', type = int, default = 300)
+    parser.add_argument('--min-rows', type = int, default = None, help = 'Shortest ticker history, defaults to a third of --dates')
+    parser.add_argument('--out', default = None, help = 'Write the per-case diffs and speedups to this csv')
+
+    args = parser.parse_args()
+
+    if int(pd.__version__.split('.')[0]) != REFERENCE_PANDAS_MAJOR:
+
+        sys.exit(f'The reference was frozen under pandas {REFERENCE_PANDAS_MAJOR}.x, found pandas {pd.__version__}')
+
+    results = run({name: ENGINES[name] for name in args.engines}, args.trials, args.seed, args.tickers, args.dates, min_rows = args.min_rows)
+
+    if args.out is not None:
+
+        results.to_csv(args.out, index = False)
+
+    summary = results.groupby(['engine', 'case']).agg(cases = ('match', 'size'),
+                                                      mismatches = ('match', lambda m: int((~m.astype(bool)).sum())),
+                                                      median_speedup = ('speedup', 'median'))
+
+    print(summary.to_string())
+
+    failed = results[~results['match'].astype(bool)]
+
+    if len(failed):
+
+        print('\nMismatched cases:')
+        print(failed.to_string())
+
+    sys.exit(1 if len(failed) else 0)
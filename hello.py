@@ -1,14 +1,30 @@
 # Import libraries
 import streamlit as st
 import pandas as pd
+import os
+import json
+import math
+import difflib
 import datetime
-import numpy as np
 import time
 from millify import millify
 import matplotlib.pyplot as plt
+from chunked import PriceStore, chunked_backtest, read_downsampled
+import strategy
+import jobs
 
 st.set_page_config('Quantitative Trading Backtester Platform 📈', layout = 'wide',)
 
+# Rows of the constituents table rendered per page
+PAGE_SIZE = 25
+
+# Memory-mapped price store built by `python chunked.py snp500prices.csv snp500prices.store`
+PRICE_STORE = 'snp500prices.store'
+
+# Streamed backtests write their daily aggregate here and only chart a sample of it
+PERFORMANCE_PATH = 'snp500prices_performance.csv'
+CHART_POINTS = 2_000
+
 # Load the data
 @st.cache_data
 def load_snp_data():
@@ -22,37 +38,82 @@ def load_stock_prices():
 
     return pd.read_csv('snp500prices.csv')  
 
-# Function to write data which prevents reruns from occuring
+# Prebuilt lookup of tickers by symbol and company name
 @st.cache_data
-def convert_df(df):
+def load_search_index():
 
-    return df.to_csv().encode("utf-8")
+    stocks = load_snp_data()
 
-# Function to execute trades
+    index = stocks[['Symbol', 'Security', 'GICS Sector']].copy()
+    index['symbol_key'] = index['Symbol'].str.lower()
+    index['name_key'] = index['Security'].str.lower()
+
+    # Map each lowercase key back to its symbol for fuzzy matching
+    keys = dict(zip(index['name_key'], index['Symbol']))
+    keys.update(zip(index['symbol_key'], index['Symbol']))
+
+    labels = {sym: f"{sym} · {name}" for sym, name in zip(index['Symbol'], index['Security'])}
+
+    return index, keys, labels
+
+# Sector groupings only need computing once per session
 @st.cache_data
-def generate_signals(ticker):
+def load_sector_groups():
 
-    # Get the data isolate
-    grp = st.session_state.df[st.session_state.df['ticker'] == ticker]
-        
-    # Calculate
-    grp['signal'] = 0.0
+    stocks = load_snp_data()
 
-    # Calculate sma
-    grp['short'] = grp['price'].rolling(window = st.session_state.shortwindow, min_periods = 1, center = False).mean()
+    return {sector: list(symbols) for sector, symbols in stocks.groupby('GICS Sector')['Symbol'].unique().items()}
 
-    # Calculate lma
-    grp['long'] = grp['price'].rolling(window = st.session_state.longwindow, min_periods = 1, center = False).mean()
+# Function to rank tickers against a query- symbol prefix, name prefix, substring, then fuzzy matches
+@st.cache_data
+def search_tickers(query, limit = 25):
 
-    # Create signals
-    grp['signal'][st.session_state.shortwindow:] = np.where(grp['short'][st.session_state.shortwindow:] > grp['long'][st.session_state.shortwindow:], 1.0, 0.0)
+    index, keys, labels = load_search_index()
 
-    # Generate trading orders
-    grp['positions'] = grp['signal'].diff()
+    q = query.strip().lower()
 
-    grp.index = pd.DatetimeIndex(grp['Date'])
-    
-    return grp
+    if not q:
+
+        return []
+
+    ranked = [index['symbol_key'].str.startswith(q),
+              index['name_key'].str.startswith(q),
+              index['symbol_key'].str.contains(q, regex = False) | index['name_key'].str.contains(q, regex = False)]
+
+    hits = []
+
+    for mask in ranked:
+
+        hits += [sym for sym in index.loc[mask, 'Symbol'] if sym not in hits]
+
+    # Fall back on fuzzy matching to catch typos
+    if len(hits) < limit:
+
+        hits += [keys[k] for k in difflib.get_close_matches(q, list(keys), n = limit, cutoff = .6) if keys[k] not in hits]
+
+    return list(dict.fromkeys(hits))[:limit]
+
+# Histories too large for memory are streamed from the price store when one exists
+@st.cache_resource
+def load_price_store():
+
+    if os.path.isdir(PRICE_STORE):
+
+        return PriceStore(PRICE_STORE)
+
+    return None
+
+# Function to write data which prevents reruns from occuring
+@st.cache_data
+def convert_df(df):
+
+    return df.to_csv().encode("utf-8")
+
+# Function to execute trades
+@st.cache_data
+def generate_signals(ticker):
+
+    return strategy.generate_signals(st.session_state.df, ticker, st.session_state.shortwindow, st.session_state.longwindow)
         
 # Use a function to define the landing page for the site
 def landing():
@@ -82,30 +143,20 @@ def portfolio():
     c0.markdown('Shown below is information regarding all members of the S&P 500, and related information..')
     c0.markdown('*Please review this data to select a portfolio for trading*')
 
-    stocks = load_snp_data()
-    c0.dataframe(stocks)
+    with c0:
+
+        constituents_table()
 
     # Isolate tickers into blocks
     c1.markdown('## Ticker Options- ')
-    options = stocks.groupby('GICS Sector')['Symbol'].unique()
-    
-    with c1.form('portfolio_creation'):
 
-        user_portfolio = []
+    with c1:
 
-        # Add items to each column
-        for i, item in enumerate(options.index):
+        ticker_picker()
 
-            # Get options
-            opts = [i for i in options[item]]
-    
-            choices = st.pills(item, opts, selection_mode = "multi", label_visibility = "visible")
+    user_portfolio = [i for i in st.session_state.selection]
 
-            for i in choices:
-            
-                user_portfolio.append(i)
-                
-        portfolio_submission = st.form_submit_button('Click here to initialize the portfolio with your chosen stocks!')
+    portfolio_submission = c1.button('Click here to initialize the portfolio with your chosen stocks!')
         
     if portfolio_submission:
 
@@ -119,14 +170,89 @@ def portfolio():
 
         c2.warning('Portfolio uninitialized, backtesting will use the entire S&P')
     
+
+# Paginated view of the constituents so only one page is sent per rerun
+@st.fragment
+def constituents_table():
+
+    stocks = load_snp_data()
+
+    # A new filter starts back on the first page
+    query = st.text_input('Filter the constituents by ticker or company name', key = 'table_filter', on_change = lambda: st.session_state.update(table_page = 1))
+
+    if query:
+
+        matches = search_tickers(query, limit = len(stocks))
+        stocks = stocks.set_index('Symbol', drop = False).loc[matches].reset_index(drop = True)
+
+    pages = max(1, math.ceil(len(stocks) / PAGE_SIZE))
+    st.session_state.table_page = min(st.session_state.get('table_page', 1), pages)
+
+    page = st.number_input(f'Page (of {pages})', 1, pages, key = 'table_page')
+
+    st.dataframe(stocks.iloc[(page - 1) * PAGE_SIZE:page * PAGE_SIZE], hide_index = True)
+    st.caption(f'Showing {min(len(stocks), (page - 1) * PAGE_SIZE + 1)}-{min(len(stocks), page * PAGE_SIZE)} of {len(stocks)} companies')
+
+# Callback to fold the pills shown for `options` into the running selection as soon as they are clicked
+def sync_picks(key, options):
+
+    picked = set(st.session_state[key] or [])
+
+    kept = [i for i in st.session_state.selection if i not in options or i in picked]
+
+    st.session_state.selection = kept + [i for i in options if i in picked and i not in kept]
+
+# Search and sector browsing for building a portfolio, reruns on its own instead of the whole page
+@st.fragment
+def ticker_picker():
+
+    labels = load_search_index()[2]
+    sectors = load_sector_groups()
+
+    if 'selection' not in st.session_state:
+
+        st.session_state.selection = []
+
+    search, browse = st.columns(2)
+
+    query = search.text_input('Search by ticker or company name', placeholder = 'e.g. AAPL, Microsoft, jp morgn')
+    matches = search_tickers(query)
+
+    # Pills always mirror the selection, so picks survive changing the query or the sector
+    if matches:
+
+        st.session_state.found_picks = [i for i in matches if i in st.session_state.selection]
+
+        search.pills('Matches', matches, selection_mode = "multi", format_func = lambda sym: labels[sym], key = 'found_picks', on_change = sync_picks, args = ('found_picks', matches))
+
+    # Only the chosen sector's symbols are rendered
+    sector = browse.selectbox('Or browse a sector', list(sectors))
+
+    st.session_state.browsed_picks = [i for i in sectors[sector] if i in st.session_state.selection]
+
+    browse.pills(sector, sectors[sector], selection_mode = "multi", key = 'browsed_picks', on_change = sync_picks, args = ('browsed_picks', sectors[sector]))
+
+    st.session_state.chosen_picks = [i for i in st.session_state.selection]
+
+    st.multiselect('Chosen Portfolio', st.session_state.selection, format_func = lambda sym: labels[sym], key = 'chosen_picks', on_change = sync_picks, args = ('chosen_picks', st.session_state.selection))
         
 def parameters():
 
     st.image('stocktrading.jpg', use_container_width = True)
 
-    st.session_state.df = load_stock_prices()
+    store = load_price_store()
+
+    if store is None:
+
+        st.session_state.df = load_stock_prices()
     
-    symbols = [i for i in st.session_state.df['ticker'].unique()]
+        symbols = [i for i in st.session_state.df['ticker'].unique()]
+
+    else:
+
+        st.session_state.df = None
+
+        symbols = [i for i in store.tickers]
 
     if st.session_state.portfolio_submission == True:
         
@@ -173,6 +299,7 @@ def parameters():
         numshares = header[0].number_input('Initialize a # of shares to start with for each stock', 100)
         shortwindow = header[1].slider('Size of Short Window- ', 0, 180, 30)
         longwindow = header[1].slider('Size of Long Window- ', 90, 270, 90)
+        memorybudget = header[3].number_input('Memory budget for streamed backtests (MB)', 512) if store is not None else 512
         
         store_parameters = header[3].form_submit_button('Store the chosen parameters..')
 
@@ -184,6 +311,7 @@ def parameters():
         st.session_state.numshares = numshares
         st.session_state.shortwindow = shortwindow
         st.session_state.longwindow = longwindow
+        st.session_state.memorybudget = memorybudget
     
 def backtesting():
 
@@ -201,9 +329,12 @@ def backtesting():
     shortwindow = st.session_state.shortwindow
     longwindow = st.session_state.longwindow
     df = st.session_state.df
+    store = load_price_store()
     
     # Fix date type
-    df['Date'] = pd.to_datetime(df['Date'])
+    if df is not None:
+
+        df['Date'] = pd.to_datetime(df['Date'])
 
     # Init df to store aggregate
     backtest = pd.DataFrame()
@@ -211,55 +342,66 @@ def backtesting():
     
     # Button to store statefulness
     execute_backtesting = c0.button("Execute backtesting!", type = "primary", icon = '📈')
+    submit_job = c0.button("Submit to the batch queue", icon = '🗂️')
+
+    if submit_job:
+
+        job_id = jobs.submit(jobs.connect(), userportfolio, startingcash, numshares, shortwindow, longwindow)
+
+        c0.success(f'Queued as job #{job_id}, see the Batch Results page once a worker picks it up')
 
     if execute_backtesting:
-        
-        # Iterate the stock symbols to calculate trade signals
-        for nm in userportfolio:
 
-            signals = pd.concat([signals, generate_signals(nm)])
+        # Symbols without prices are left out of the backtest instead of failing it
+        if store is not None:
 
-        signals.set_index('Date', inplace = True)
+            traded, missing = store.split_tickers(userportfolio)
 
-        if 'signals' not in st.session_state:
+        else:
 
-            st.session_state.signals = signals
-            
-        # Iterate the trades to calculate earnings
-        for nm, grp in signals.groupby('ticker'):
+            priced = set(df['ticker'].unique())
+            traded = [i for i in userportfolio if i in priced]
+            missing = [i for i in userportfolio if i not in priced]
 
-            pos = pd.DataFrame(index = grp.index).fillna(0)
+        if missing:
 
-            # Trigger to purchase specificed shares of each stock
-            pos['shares'] = numshares * grp['signal']
+            st.warning(f'No prices found for {missing}, these were left out of the backtest')
 
-            portfolio = pos.multiply(grp['price'], axis = 0)
-            pos_diff = pos.diff()
+        if not traded:
 
-            # Add `holdings` to portfolio
-            portfolio['holdings'] = (pos.multiply(grp['price'], axis = 0)).sum(axis = 1)
+            st.error('None of the chosen stocks have prices')
 
-            # Add `cash` to portfolio
-            portfolio['cash'] = startingcash - (pos_diff.multiply(grp['price'], axis = 0)).sum(axis = 1).cumsum()   
+            return
+        
+        if store is not None:
 
-            # Add `total` to portfolio
-            portfolio['total'] = portfolio['cash'] + portfolio['holdings']
+            # Stream the price history through the memory budget, the daily aggregate goes to disk and only a sample is charted
+            chunked_backtest(store, traded, startingcash, numshares, shortwindow, longwindow, st.session_state.memorybudget * 1024 ** 2, performance_path = PERFORMANCE_PATH)
 
-            # Add `returns` to portfolio
-            portfolio['returns'] = portfolio['total'].pct_change() 
-    
-            portfolio['ticker'] = nm
-    
-            backtest = pd.concat([backtest, portfolio])
+            performance = read_downsampled(PERFORMANCE_PATH, CHART_POINTS)
+
+        else:
+
+            # Iterate the stock symbols to calculate trade signals
+            for nm in traded:
+
+                signals = pd.concat([signals, generate_signals(nm)])
 
-        if 'backtest' not in st.session_state:
+            signals.set_index('Date', inplace = True)
 
-            st.session_state['backtest'] = backtest
+            if 'signals' not in st.session_state:
+
+                st.session_state.signals = signals
+            
+            # Iterate the trades to calculate earnings
+            backtest = strategy.portfolio_backtest(signals, startingcash, numshares)
+
+            if 'backtest' not in st.session_state:
+
+                st.session_state['backtest'] = backtest
         
-        # Compile the performance from all stocks
-        performance = backtest.groupby(backtest.index).agg({'holdings': 'sum',
-                                                                'cash': 'sum',
-                                                                'total': 'sum'})
+            # Compile the performance from all stocks
+            performance = strategy.aggregate_performance(backtest)
 
         if 'performance' not in st.session_state: 
                 
@@ -267,15 +409,15 @@ def backtesting():
             st.session_state.endingcash = performance['total'].iloc[-1]
 
         # Compute the returns
-        st.session_state.delta = st.session_state.endingcash / (startingcash * len(userportfolio))
+        st.session_state.delta = st.session_state.endingcash / (startingcash * len(traded))
 
         st.success(f'Backtesting is complete!')
 
         # Compile the performance result
         stats1, stats2, stats3 = c1.columns(3)
        
-        stats1.metric('# of Stocks in Portfolio- ', len(userportfolio))
-        stats2.metric('Total Investment:         ', f"${millify(startingcash * len(userportfolio))}")
+        stats1.metric('# of Stocks in Portfolio- ', len(traded))
+        stats2.metric('Total Investment:         ', f"${millify(startingcash * len(traded))}")
         stats3.metric('Ending Balance:           ', f"${round(st.session_state.endingcash, 2)}", delta = round(st.session_state.delta, 3)) 
 
         st.markdown(f'<p align="center">Aggregate Performance of Portfolio from: {str(start)[0:10]} :: {str(end)[0:10]}', unsafe_allow_html = True)
@@ -283,13 +425,21 @@ def backtesting():
         st.line_chart(performance, y = 'total', y_label = 'Total ($)', x_label = 'Month')
 
         # Compute output files
-        pos = convert_df(st.session_state.signals)
         rets = convert_df(st.session_state.performance)
 
-        download_signals = st.download_button(label = "Download the signals data as .csv",
-                                              data = pos,
-                                              file_name = "quant_trading_signals.csv",
-                                              mime = "text/csv")
+        # Per-ticker signals are only kept in memory for the in-memory backtest
+        if 'signals' in st.session_state:
+
+            pos = convert_df(st.session_state.signals)
+
+            download_signals = st.download_button(label = "Download the signals data as .csv",
+                                                  data = pos,
+                                                  file_name = "quant_trading_signals.csv",
+                                                  mime = "text/csv")
+
+        if store is not None:
+
+            st.caption(f'Charted and downloadable data is a {CHART_POINTS} point sample, the full daily aggregate is in {PERFORMANCE_PATH}')
 
         download_returns = st.download_button(label = "Download the backtest data as .csv",
                                               data = rets,
@@ -311,6 +461,13 @@ def visuals():
     shortwindow = st.session_state.shortwindow
     longwindow = st.session_state.longwindow
     df = st.session_state.df
+
+    if df is None:
+
+        st.warning('Drill down visuals are unavailable when backtesting is streamed from the price store')
+
+        return
+
     signals = st.session_state.signals
     backtest = st.session_state.backtest
 
@@ -355,12 +512,63 @@ def visuals():
 
     st.pyplot(plt)
 
+# Function to browse backtests run by the batch workers
+def batch():
+
+    st.image('stocktrading.jpg', use_container_width = True)
+    st.markdown(f"# {list(page_names_to_funcs.keys())[5]}")
+    st.markdown('Start workers on any host sharing this folder with `python jobs.py worker`')
+
+    conn = jobs.connect()
+    summary = jobs.stats(conn)
+
+    # Queue overview
+    stats1, stats2, stats3, stats4 = st.columns(4)
+
+    stats1.metric('Queued', summary['counts'].get('queued', 0))
+    stats2.metric('Running', summary['counts'].get('running', 0))
+    stats3.metric('Completed', summary['counts'].get('done', 0))
+    stats4.metric('Jobs / min (last hour)', round(summary['jobs_per_minute'], 2))
+
+    history = jobs.list_jobs(conn)
+    st.dataframe(history.drop(columns = ['heartbeat', 'results']), hide_index = True)
+
+    completed = history[history['status'] == 'done']
+
+    if completed.empty:
+
+        st.warning('No completed jobs yet')
+
+        return
+
+    # Drill into one finished job
+    job_id = st.selectbox('Choose a completed job to review..', completed['id'])
+    job = completed[completed['id'] == job_id].iloc[0]
+    params = json.loads(job['params'])
+
+    performance = jobs.load_performance(job)
+    traded = int(job['traded'])
+
+    stats1, stats2, stats3 = st.columns(3)
+
+    stats1.metric('# of Stocks in Portfolio- ', traded)
+    stats2.metric('Total Investment:         ', f"${millify(params['startingcash'] * traded)}")
+    stats3.metric('Ending Balance:           ', f"${round(job['endingcash'], 2)}", delta = round(job['endingcash'] / (params['startingcash'] * traded), 3))
+
+    st.line_chart(performance, y = 'total', y_label = 'Total ($)', x_label = 'Month')
+
+    st.download_button(label = "Download the backtest data as .csv",
+                       data = convert_df(performance),
+                       file_name = f"quant_trading_backtest_{job_id}.csv",
+                       mime = "text/csv")
+
 # Define the layout for all pages
 page_names_to_funcs = {"—": landing,
                        "Portfolio Selection": portfolio,
                        "Parameterization": parameters,
                        "Backtesting": backtesting,
-                       "Visualizations": visuals}
+                       "Visualizations": visuals,
+                       "Batch Results": batch}
 
 demo_name = st.sidebar.selectbox("Choose a demo", page_names_to_funcs.keys())
 page_names_to_funcs[demo_name]()
\ No newline at end of file
@@ -0,0 +1,391 @@
+# Import libraries
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import pandas as pd
+import strategy
+from chunked import PriceStore, chunked_backtest
+
+# Default locations, both should live on a filesystem every worker host can reach. Set them through
+# the environment so the dashboard and every worker agree on where the queue is
+JOBS_DB = os.environ.get('QUANT_JOBS_DB', 'jobs.db')
+RESULTS_DIR = os.environ.get('QUANT_RESULTS_DIR', 'results')
+
+# A running job whose worker has not checked in for this many seconds is presumed dead
+LEASE_SECONDS = 300
+
+# Jobs are failed for good after this many claims
+MAX_ATTEMPTS = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    submitted REAL NOT NULL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    endingcash REAL,
+    traded INTEGER,
+    results TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+'''
+
+# Function to open the queue, creating it on first use
+def connect(db_path = JOBS_DB):
+
+    conn = sqlite3.connect(db_path, timeout = 60, isolation_level = None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+
+    # Queues created before result paths were recorded lack the column
+    if 'results' not in [row['name'] for row in conn.execute('PRAGMA table_info(jobs)')]:
+
+        conn.execute('ALTER TABLE jobs ADD COLUMN results TEXT')
+
+    return conn
+
+# Function to queue one backtest- a portfolio of tickers plus the strategy parameters
+def submit(conn, portfolio, startingcash, numshares, shortwindow, longwindow):
+
+    params = {'startingcash': startingcash,
+              'numshares': numshares,
+              'shortwindow': shortwindow,
+              'longwindow': longwindow}
+
+    cur = conn.execute('INSERT INTO jobs (portfolio, params, submitted) VALUES (?, ?, ?)',
+                       (json.dumps(list(portfolio)), json.dumps(params), time.time()))
+
+    return cur.lastrowid
+
+# Function to put jobs held by dead workers back on the queue
+def requeue_expired(conn, lease = LEASE_SECONDS, max_attempts = MAX_ATTEMPTS):
+
+    cutoff = time.time() - lease
+
+    conn.execute('BEGIN IMMEDIATE')
+
+    try:
+
+        conn.execute("UPDATE jobs SET status = 'failed', error = 'worker lost', finished = ? "
+                     "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?", (time.time(), cutoff, max_attempts))
+        conn.execute("UPDATE jobs SET status = 'queued', worker = NULL "
+                     "WHERE status = 'running' AND heartbeat < ?", (cutoff,))
+        conn.execute('COMMIT')
+
+    except Exception:
+
+        conn.execute('ROLLBACK')
+        raise
+
+# Function to atomically claim the oldest queued job, returns None when the queue is empty
+def claim(conn, worker):
+
+    # BEGIN IMMEDIATE takes the write lock up front so two workers can never select the same row
+    conn.execute('BEGIN IMMEDIATE')
+
+    try:
+
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+
+        if row is not None:
+
+            now = time.time()
+
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, started = ?, heartbeat = ? WHERE id = ?",
+                         (worker, now, now, row['id']))
+
+        conn.execute('COMMIT')
+
+    except Exception:
+
+        conn.execute('ROLLBACK')
+        raise
+
+    return row
+
+# Function to record that a worker is still alive and holding a job
+def heartbeat(conn, job_id, worker):
+
+    conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'", (time.time(), job_id, worker))
+
+# Function to mark a claimed job done and publish its staged result files
+#
+# Both happen under the write lock and only if this worker still holds the job, so a worker whose
+# lease lapsed can never overwrite the results of the worker that took the job over. The published
+# paths are recorded on the job so readers find them wherever the worker wrote them. Returns whether
+# the job was still ours.
+def complete(conn, job_id, worker, endingcash, traded, staged = None):
+
+    staged = staged or {}
+    published = {kind: os.path.abspath(final) for kind, (tmp, final) in staged.items()}
+
+    conn.execute('BEGIN IMMEDIATE')
+
+    try:
+
+        cur = conn.execute("UPDATE jobs SET status = 'done', finished = ?, endingcash = ?, traded = ?, results = ?, error = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+                           (time.time(), endingcash, traded, json.dumps(published), job_id, worker))
+
+        owned = cur.rowcount == 1
+
+        if owned:
+
+            for tmp, final in staged.values():
+
+                os.replace(tmp, final)
+
+        conn.execute('COMMIT')
+
+    except Exception:
+
+        conn.execute('ROLLBACK')
+        raise
+
+    return owned
+
+# Function to mark a claimed job failed
+def fail(conn, job_id, worker, error):
+
+    conn.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                 (time.time(), error, job_id, worker))
+
+# Function to list jobs for browsing, newest first
+def list_jobs(conn, status = None):
+
+    query = 'SELECT * FROM jobs' + ('' if status is None else ' WHERE status = ?') + ' ORDER BY id DESC'
+
+    jobs = pd.read_sql_query(query, conn, params = () if status is None else (status,))
+
+    for col in ['submitted', 'started', 'heartbeat', 'finished']:
+
+        jobs[col] = pd.to_datetime(jobs[col], unit = 's')
+
+    return jobs
+
+# Function to summarise the queue- job counts by status and completions per minute over a window
+def stats(conn, window = 3600):
+
+    counts = {row['status']: row['n'] for row in conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+    finished = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done' AND finished >= ?", (time.time() - window,)).fetchone()[0]
+
+    return {'counts': counts, 'jobs_per_minute': finished / (window / 60)}
+
+# Result files of one job
+def result_paths(job_id, results_dir = RESULTS_DIR):
+
+    return {'performance': os.path.join(results_dir, f'{job_id}_performance.csv'),
+            'backtest': os.path.join(results_dir, f'{job_id}_backtest.csv')}
+
+# Function to load the stored aggregate performance of a finished job from where its worker published it
+def load_performance(job):
+
+    if job['results'] is None:
+
+        raise FileNotFoundError(f"Job {job['id']} has no published results")
+
+    return pd.read_csv(json.loads(job['results'])['performance'], index_col = 0, parse_dates = True)
+
+# Function to run a claimed job and stage its results
+#
+# Returns the ending balance, the # of stocks traded and a {kind: (temporary path, final path)} map of
+# the staged result files for complete() to publish.
+def run_job(job, prices, results_dir = RESULTS_DIR, memory_budget = None):
+
+    portfolio = json.loads(job['portfolio'])
+    params = json.loads(job['params'])
+    paths = result_paths(job['id'], results_dir)
+
+    # Write to temporary names, complete() renames them so readers never see half-written results
+    tmp = {k: f"{v}.{socket.gethostname()}.{os.getpid()}.tmp" for k, v in paths.items()}
+
+    if isinstance(prices, PriceStore):
+
+        kwargs = {} if memory_budget is None else {'memory_budget': memory_budget}
+
+        # Symbols without prices are left out instead of failing the job
+        traded = prices.split_tickers(portfolio)[0]
+
+        if not traded:
+
+            raise ValueError(f'No prices found for any of {portfolio}')
+
+        performance = chunked_backtest(prices, traded, params['startingcash'], params['numshares'], params['shortwindow'], params['longwindow'],
+                                       backtest_path = tmp['backtest'], performance_path = tmp['performance'], **kwargs)
+
+    else:
+
+        # Symbols without prices are left out, generate_signals cannot handle a ticker with no rows
+        priced = set(prices['ticker'].unique())
+        traded = [i for i in portfolio if i in priced]
+
+        if not traded:
+
+            raise ValueError(f'No prices found for any of {portfolio}')
+
+        signals = strategy.portfolio_signals(prices, traded, params['shortwindow'], params['longwindow'])
+        backtest = strategy.portfolio_backtest(signals, params['startingcash'], params['numshares'])
+        performance = strategy.aggregate_performance(backtest)
+
+        backtest.to_csv(tmp['backtest'])
+        performance.to_csv(tmp['performance'])
+
+    staged = {k: (tmp[k], paths[k]) for k in paths if os.path.exists(tmp[k])}
+
+    return performance['total'].iloc[-1], len(traded), staged
+
+# Function to load prices once per worker- the memory-mapped store if given a directory, else the csv
+def load_prices(path):
+
+    if os.path.isdir(path):
+
+        return PriceStore(path)
+
+    df = pd.read_csv(path)
+    df['Date'] = pd.to_datetime(df['Date'])
+
+    return df
+
+# Worker loop- claim, run, record, repeat
+def work(db_path = JOBS_DB, prices_path = 'snp500prices.csv', results_dir = RESULTS_DIR, poll = 5, once = False, lease = LEASE_SECONDS, memory_budget = None):
+
+    os.makedirs(results_dir, exist_ok = True)
+
+    conn = connect(db_path)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    prices = load_prices(prices_path)
+
+    done = 0
+    began = time.time()
+
+    while True:
+
+        requeue_expired(conn, lease)
+
+        job = claim(conn, worker)
+
+        if job is None:
+
+            if once:
+
+                break
+
+            time.sleep(poll)
+
+            continue
+
+        # Keep the lease alive from a separate connection while the backtest runs
+        stop = threading.Event()
+
+        def beat(job_id = job['id']):
+
+            beat_conn = None
+
+            while not stop.wait(lease / 3):
+
+                # A locked database must not kill the thread, keep retrying until the beat lands
+                while not stop.is_set():
+
+                    try:
+
+                        beat_conn = beat_conn or connect(db_path)
+                        heartbeat(beat_conn, job_id, worker)
+
+                        break
+
+                    except sqlite3.Error as e:
+
+                        print(f'[{worker}] heartbeat for job {job_id} failed, retrying: {e!r}', flush = True)
+
+                        stop.wait(1)
+
+            if beat_conn is not None:
+
+                beat_conn.close()
+
+        beater = threading.Thread(target = beat, daemon = True)
+        beater.start()
+
+        staged = {}
+
+        try:
+
+            endingcash, traded, staged = run_job(job, prices, results_dir, memory_budget)
+
+            if complete(conn, job['id'], worker, float(endingcash), traded, staged):
+
+                done += 1
+
+            else:
+
+                print(f"[{worker}] lost the lease on job {job['id']}, discarding its results", flush = True)
+
+        except Exception as e:
+
+            fail(conn, job['id'], worker, repr(e))
+
+        finally:
+
+            stop.set()
+            beater.join()
+
+            # Anything still staged was never published
+            for tmp, _ in staged.values():
+
+                if os.path.exists(tmp):
+
+                    os.remove(tmp)
+
+        elapsed = time.time() - began
+
+        print(f"[{worker}] job {job['id']} finished, {done} done in {elapsed:.0f}s ({done / elapsed * 60:.2f} jobs/min)", flush = True)
+
+    conn.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Batch backtest job queue')
+    parser.add_argument('--db', default = JOBS_DB, help = 'SQLite queue file shared by all workers')
+    sub = parser.add_subparsers(dest = 'command', required = True)
+
+    w = sub.add_parser('worker', help = 'Claim and run queued jobs')
+    w.add_argument('--prices', default = 'snp500prices.csv', help = 'Price csv, or a store built by chunked.py')
+    w.add_argument('--results', default = RESULTS_DIR, help = 'Shared directory for job results')
+    w.add_argument('--poll', type = float, default = 5, help = 'Seconds to wait when the queue is empty')
+    w.add_argument('--lease', type = float, default = LEASE_SECONDS, help = 'Seconds without a heartbeat before a job is retried')
+    w.add_argument('--memory-budget', type = int, default = None, help = 'MB budget when streaming from a price store')
+    w.add_argument('--once', action = 'store_true', help = 'Exit when the queue is empty')
+
+    s = sub.add_parser('submit', help = 'Queue a backtest')
+    s.add_argument('tickers', nargs = '+')
+    s.add_argument('--startingcash', type = float, default = 10000)
+    s.add_argument('--numshares', type = int, default = 100)
+    s.add_argument('--shortwindow', type = int, default = 30)
+    s.add_argument('--longwindow', type = int, default = 90)
+
+    sub.add_parser('stats', help = 'Show queue counts and throughput')
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+
+        work(args.db, args.prices, args.results, args.poll, args.once, args.lease,
+             None if args.memory_budget is None else args.memory_budget * 1024 ** 2)
+
+    elif args.command == 'submit':
+
+        print(submit(connect(args.db), args.tickers, args.startingcash, args.numshares, args.shortwindow, args.longwindow))
+
+    else:
+
+        print(json.dumps(stats(connect(args.db)), indent = 2))
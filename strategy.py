@@ -0,0 +1,83 @@
+# Import libraries
+import pandas as pd
+import numpy as np
+
+# Function to execute trades for one ticker w/ a moving average crossover
+def generate_signals(df, ticker, shortwindow, longwindow):
+
+    # Get the data isolate
+    grp = df[df['ticker'] == ticker]
+
+    # Calculate
+    grp['signal'] = 0.0
+
+    # Calculate sma
+    grp['short'] = grp['price'].rolling(window = shortwindow, min_periods = 1, center = False).mean()
+
+    # Calculate lma
+    grp['long'] = grp['price'].rolling(window = longwindow, min_periods = 1, center = False).mean()
+
+    # Create signals
+    grp['signal'][shortwindow:] = np.where(grp['short'][shortwindow:] > grp['long'][shortwindow:], 1.0, 0.0)
+
+    # Generate trading orders
+    grp['positions'] = grp['signal'].diff()
+
+    grp.index = pd.DatetimeIndex(grp['Date'])
+
+    return grp
+
+# Function to calculate trade signals for every stock in a portfolio
+def portfolio_signals(df, userportfolio, shortwindow, longwindow):
+
+    signals = pd.DataFrame()
+
+    # Iterate the stock symbols to calculate trade signals
+    for nm in userportfolio:
+
+        signals = pd.concat([signals, generate_signals(df, nm, shortwindow, longwindow)])
+
+    signals.set_index('Date', inplace = True)
+
+    return signals
+
+# Function to calculate the earnings of each stock from its trade signals
+def portfolio_backtest(signals, startingcash, numshares):
+
+    backtest = pd.DataFrame()
+
+    # Iterate the trades to calculate earnings
+    for nm, grp in signals.groupby('ticker'):
+
+        pos = pd.DataFrame(index = grp.index).fillna(0)
+
+        # Trigger to purchase specificed shares of each stock
+        pos['shares'] = numshares * grp['signal']
+
+        portfolio = pos.multiply(grp['price'], axis = 0)
+        pos_diff = pos.diff()
+
+        # Add `holdings` to portfolio
+        portfolio['holdings'] = (pos.multiply(grp['price'], axis = 0)).sum(axis = 1)
+
+        # Add `cash` to portfolio
+        portfolio['cash'] = startingcash - (pos_diff.multiply(grp['price'], axis = 0)).sum(axis = 1).cumsum()
+
+        # Add `total` to portfolio
+        portfolio['total'] = portfolio['cash'] + portfolio['holdings']
+
+        # Add `returns` to portfolio
+        portfolio['returns'] = portfolio['total'].pct_change()
+
+        portfolio['ticker'] = nm
+
+        backtest = pd.concat([backtest, portfolio])
+
+    return backtest
+
+# Function to compile the performance from all stocks
+def aggregate_performance(backtest):
+
+    return backtest.groupby(backtest.index).agg({'holdings': 'sum',
+                                                 'cash': 'sum',
+                                                 'total': 'sum'})